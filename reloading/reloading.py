@@ -1,11 +1,22 @@
-import inspect
 import sys
+import os
 import ast
+import copy
+import errno
+import hashlib
+import time
 import traceback
 import types
-from itertools import chain
+from bisect import bisect_left
+from collections import ChainMap, OrderedDict
 from functools import partial, update_wrapper
 
+try:
+    # optional, lets us sleep until an editor has finished writing a file
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 
 # have to make our own partial in case someone wants to use reloading as a iterator without any arguments
 # they would get a partial back because a call without a iterator argument is assumed to be a decorator.
@@ -19,7 +30,8 @@ class no_iter_partial(partial):
 
 def reloading(fn_or_seq=None, every=1, forever=None):
     """Wraps a loop iterator or decorates a function to reload the source code
-    before every loop iteration or function invocation.
+    before every loop iteration or function invocation, if the source file
+    has changed.
 
     When wrapped around the outermost iterator in a `for` loop, e.g.
     `for i in reloading(range(10))`, causes the loop body to reload from source
@@ -27,14 +39,15 @@ def reloading(fn_or_seq=None, every=1, forever=None):
     When used as a function decorator, the decorated function is reloaded from
     source before each execution.
 
-    Pass the integer keyword argument `every` to reload the source code
-    only every n-th iteration/invocation.
+    Pass the integer keyword argument `every` to check the source file for
+    changes only every n-th iteration/invocation.
 
     Args:
         fn_or_seq (function | iterable): A function or loop iterator which should
             be reloaded from source before each invocation or iteration,
             respectively
-        every (int, Optional): After how many iterations/invocations to reload
+        every (int, Optional): After how many iterations/invocations to check
+            for changes and reload
         forever (bool, Optional): Pass `forever=true` instead of an iterator to
             create an endless loop
 
@@ -52,9 +65,38 @@ def reloading(fn_or_seq=None, every=1, forever=None):
     return decorator
 
 
-def unique_name(used):
-    # get the longest element of the used names and append a "0"
-    return max(used, key=len) + "0"
+# name of the function that module level loop bodies are compiled into
+BODY_FUNCTION_NAME = "__reloading_body__"
+# name of the function that unpacks the values of a loop iteration
+UNPACK_FUNCTION_NAME = "__reloading_unpack__"
+
+# compiled code is cached per source file state, so that reloading an unchanged
+# file skips reading, parsing and compiling it again
+CODE_CACHE_SIZE = 32
+_LOOP_CODE_CACHE = OrderedDict()
+_FUNC_CODE_CACHE = OrderedDict()
+# the same by hash of the source, for files saved without changes
+_LOOP_CODE_CONTENT_CACHE = OrderedDict()
+_FUNC_CODE_CONTENT_CACHE = OrderedDict()
+# parsed trees by hash of the source, for reloads of textually unchanged files
+_AST_CACHE = OrderedDict()
+
+
+def cache_get(cache, key):
+    """Returns the value cached under `key` or None and marks it as recently used"""
+    try:
+        cache.move_to_end(key)
+    except KeyError:
+        return None
+    return cache[key]
+
+
+def cache_put(cache, key, value):
+    """Stores `value` under `key` and evicts the least recently used entries"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CODE_CACHE_SIZE:
+        cache.popitem(last=False)
 
 
 def format_itervars(ast_node):
@@ -64,192 +106,538 @@ def format_itervars(ast_node):
     if isinstance(ast_node, ast.Name):
         return ast_node.id
 
-    names = []
-    for child in ast_node.elts:
-        if isinstance(child, ast.Name):
-            names.append(child.id)
-        elif isinstance(child, ast.Tuple) or isinstance(child, ast.List):
-            # if its another tuple, like "a, (b, c)", recurse
-            names.append("({})".format(format_itervars(child)))
+    # use a stack instead of recursing into nested tuples like "a, (b, c)".
+    # each entry holds the remaining children of a tuple and its names so far
+    stack = [(iter(ast_node.elts), [])]
+    while True:
+        children, names = stack[-1]
+        for child in children:
+            if isinstance(child, ast.Name):
+                names.append(child.id)
+            elif isinstance(child, ast.Tuple) or isinstance(child, ast.List):
+                stack.append((iter(child.elts), []))
+                break
+        else:
+            stack.pop()
+            formatted = ", ".join(names)
+            if not stack:
+                return formatted
+            stack[-1][1].append("({})".format(formatted))
+
+
+def read_file(path):
+    """Returns the contents of path as bytes"""
+    # read with plain syscalls, source files are small, so the buffering and
+    # incremental decoding of a text file object don't pay off
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b"".join(chunks)
+
+
+def get_file_size(path):
+    """Returns the size of path or 0 if it doesn't exist, e.g. while an editor replaces it"""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def get_file_stamp(path):
+    """Returns the mtime and size of path or None if it doesn't exist, e.g. while an
+    editor replaces it. A missing file counts as changed and load_file waits for it"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def wait_for_write(path, delay):
+    """Waits until path may have been written to. Returns the delay to use
+    for the next wait when polling"""
+    if INotify is not None:
+        with INotify() as inotify:
+            inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                              inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+            # check again after adding the watch, so that we don't miss the write
+            if get_file_size(path) == 0:
+                inotify.read(timeout=50)
+        return delay
+    time.sleep(delay)
+    return min(delay * 2, 0.05)
+
 
-    return ", ".join(names)
+def check_source_file(path):
+    """Raises if path is not a file, e.g. for code run with `python -c`, from stdin
+    or in a REPL. Only files that existed are waited for while they are saved"""
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, "reloading needs the source file of the code", path)
 
 
 def load_file(path):
-    src = ""
-    # while loop here since while saving, the file may sometimes be empty.
-    while (src == ""):
-        with open(path, "r") as f:
-            src = f.read()
-    return src + "\n"
+    # while saving, the file may sometimes be empty, missing or incomplete.
+    # check its size before opening it and wait for the editor to finish
+    # writing instead of reading it in a busy loop. returns the raw bytes,
+    # which parse_file_until_successful hashes before decoding.
+    delay = 0.001
+    while True:
+        size = get_file_size(path)
+        if size > 0:
+            try:
+                src = read_file(path)
+            except FileNotFoundError:
+                src = b""
+            # a shorter read means the file got truncated by the next write
+            if len(src) >= size:
+                return src
+        delay = wait_for_write(path, delay)
 
 
 def parse_file_until_successful(path):
-    source = load_file(path)
+    """Returns the parsed tree, the source it was parsed from and a hash of the source"""
     while True:
+        # hash the bytes as read instead of encoding the decoded source again
+        data = load_file(path)
+        source_hash = hashlib.blake2b(data, digest_size=16).digest()
+        source = data.decode("utf-8") + "\n"
+        tree = cache_get(_AST_CACHE, source_hash)
+        if tree is not None:
+            return tree, source, source_hash
         try:
-            tree = ast.parse(source)
-            return tree
+            tree = ast.parse(source, filename=path)
+            cache_put(_AST_CACHE, source_hash, tree)
+            return tree, source, source_hash
         except SyntaxError:
             handle_exception(path)
-            source = load_file(path)
 
 
-def isolate_loop_body_and_get_itervars(tree, lineno, loop_id):
-    """Modifies tree inplace as unclear how to create ast.Module.
-    Returns itervars"""
-    candidate_nodes = []
-    for node in ast.walk(tree):
+class StatementVisitor(ast.NodeVisitor):
+    """Visits only the statements of a tree, as loops and function definitions
+    can't be nested inside expressions. Function and class bodies are skipped
+    unless they mention `reloading` in the source."""
+
+    def __init__(self, source):
+        self.reloading_lines = [
+            i for i, line in enumerate(source.splitlines(), 1) if "reloading" in line
+        ]
+
+    def generic_visit(self, node):
+        for field in ("body", "orelse", "finalbody", "handlers", "cases"):
+            for child in getattr(node, field, ()):
+                self.visit(child)
+
+    def visit_FunctionDef(self, node):
+        if self.mentions_reloading(node):
+            self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def mentions_reloading(self, node):
+        end_lineno = getattr(node, "end_lineno", None)
+        if end_lineno is None:
+            # python < 3.8 doesn't know where a node ends
+            return True
+        i = bisect_left(self.reloading_lines, node.lineno)
+        return i < len(self.reloading_lines) and self.reloading_lines[i] <= end_lineno
+
+
+class ReloadingLoopFinder(StatementVisitor):
+    """Finds the `for` loop using `reloading` either by its loop_id or line"""
+
+    def __init__(self, source, lineno, loop_id):
+        super(ReloadingLoopFinder, self).__init__(source)
+        self.lineno = lineno
+        self.loop_id = loop_id
+        self.loop_node = None
+        self.at_module_level = False
+        self.nesting = 0
+
+    def visit_FunctionDef(self, node):
+        # keep track of whether the loop is defined in the module scope
+        self.nesting += 1
+        super(ReloadingLoopFinder, self).visit_FunctionDef(node)
+        self.nesting -= 1
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_For(self, node):
         if (
-            isinstance(node, ast.For)
-            and isinstance(node.iter, ast.Call)
-            and node.iter.func.id == "reloading"
+            isinstance(node.iter, ast.Call)
+            and getattr(node.iter.func, "id", None) == "reloading"
             and (
-                    (loop_id is not None and loop_id == get_loop_id(node))
-                    or getattr(node, "lineno", None) == lineno
+                    (self.loop_id is not None and self.loop_id == get_loop_id(node))
+                    or getattr(node, "lineno", None) == self.lineno
                 )
             ):
-            candidate_nodes.append(node)
+            if self.loop_node is not None:
+                raise LookupError(
+                    "The reloading loop is ambigious. Use `reloading` only once per line and make sure that the code in that line is unique within the source file."
+                )
+            self.loop_node = node
+            self.at_module_level = self.nesting == 0
+        self.generic_visit(node)
 
-    if len(candidate_nodes) > 1:
-        raise LookupError(
-            "The reloading loop is ambigious. Use `reloading` only once per line and make sure that the code in that line is unique within the source file."
-        )
 
-    if len(candidate_nodes) < 1:
+def isolate_loop_body_and_get_itervars(tree, source, lineno, loop_id):
+    """Returns the body, the iteration variables, the loop_id and whether the
+    reloading loop is in the module scope without modifying the tree"""
+    finder = ReloadingLoopFinder(source, lineno, loop_id)
+    finder.visit(tree)
+
+    if finder.loop_node is None:
         raise LookupError(
             "Could not locate reloading loop. Please make sure the code in the line that uses `reloading` doesn't change between reloads."
         )
 
-    loop_node = candidate_nodes[0]
-    tree.body = loop_node.body
-    return loop_node.target, get_loop_id(loop_node)
+    loop_node = finder.loop_node
+    return loop_node.body, loop_node.target, get_loop_id(loop_node), finder.at_module_level
+
+
+def get_itervar_names(ast_node):
+    """Returns the names of the loop iteration variables in order, e.g. ['a', 'b', 'c'] for 'a, (b, c)'"""
+    if isinstance(ast_node, ast.Name):
+        return [ast_node.id]
+
+    names = []
+    for child in getattr(ast_node, "elts", ()):
+        names.extend(get_itervar_names(child))
+    return names
+
+
+# nodes other than names that bind a name, i.e. except handlers and match patterns
+NAME_BINDING_NODES = (ast.ExceptHandler,) + tuple(
+    getattr(ast, node_type) for node_type in ("MatchAs", "MatchStar", "MatchMapping") if hasattr(ast, node_type)
+)
+
+
+# builtins that act on the local namespace, which is the module namespace in a
+# module level loop, but would be the namespace of the function wrapping the body
+NAMESPACE_BUILTINS = {"exec", "eval", "locals", "vars", "dir"}
+
+
+def get_assigned_names(body):
+    """Returns the names which the statements in body bind in their scope or
+    None if body can't be moved into a function without changing its meaning"""
+    names = set()
+    nodes = list(body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.Return, ast.Yield, ast.YieldFrom, ast.Await)):
+            return None
+        if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            # annotated names can't be declared global
+            return None
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            # the name is bound here, but the body has its own scope
+            names.add(node.name)
+            continue
+        if isinstance(node, ast.Lambda):
+            continue
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                if node.id in NAMESPACE_BUILTINS:
+                    return None
+            else:
+                names.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                names.add(alias.asname or alias.name.split(".")[0])
+            continue
+        elif isinstance(node, NAME_BINDING_NODES):
+            name = getattr(node, "name", None) or getattr(node, "rest", None)
+            if name is not None:
+                names.add(name)
+        nodes.extend(ast.iter_child_nodes(node))
+    return names
+
+
+def make_body_function(body, itervar_names):
+    """Wraps the loop body in a function without arguments, so that it is called
+    instead of being exec'd every iteration. The loop iteration variables and the
+    names assigned in the body are declared global, so that the body sees them
+    in the module namespace, just like in a plain loop. Returns None if the body
+    can't be wrapped."""
+    assigned_names = get_assigned_names(body)
+    if assigned_names is None:
+        return None
+
+    func = ast.parse("def {}(): pass".format(BODY_FUNCTION_NAME)).body[0]
+    func.body = list(body)
+    global_names = assigned_names | set(itervar_names)
+    if global_names:
+        func.body.insert(0, ast.Global(names=sorted(global_names)))
+    # keep the line numbers of the body, so that tracebacks point into the loop
+    ast.copy_location(func, body[0])
+    return func
 
 
 def get_loop_id(ast_node):
-    """Generates a unique identifier for an `ast_node` of type ast.For to find the loop in the changed source file
+    """Generates a unique identifier for an `ast_node` of type ast.For to find the loop in the changed source file.
+    The identifier is a short digest, as it is compared against every candidate loop and used in cache keys
     """
-    return ast.dump(ast_node.target) + "__" + ast.dump(ast_node.iter)
+    loop_dump = ast.dump(ast_node.target) + "__" + ast.dump(ast_node.iter)
+    return hashlib.blake2b(loop_dump.encode("utf-8"), digest_size=16).digest()
 
 
-def get_loop_code(loop_frame_info, loop_id):
-    fpath = loop_frame_info[1]
+def get_unpack_code(itervars, itervar_names):
+    """Compiles a function which unpacks the values of a loop iteration into a
+    flat tuple in the order of itervar_names. Returns None for a single loop var"""
+    if isinstance(itervars, ast.Name):
+        return None
+    src = "def {}(values):\n    {} = values\n    return ({},)\n".format(
+        UNPACK_FUNCTION_NAME, format_itervars(itervars), ", ".join(itervar_names)
+    )
+    return compile(src, filename="<reloading-unpack>", mode="exec")
+
+
+def get_loop_code(fpath, lineno, loop_id):
+    stamp = get_file_stamp(fpath)
+    # lineno is part of the key as the loop_id is not known before the first load
+    key = None if stamp is None else (fpath, stamp, lineno, loop_id)
+    if key is not None:
+        cached = cache_get(_LOOP_CODE_CACHE, key)
+        if cached is not None:
+            return cached
+
     while True:
-        tree = parse_file_until_successful(fpath)
+        tree, source, source_hash = parse_file_until_successful(fpath)
+        # the file may have been saved without changing it
+        content_key = (fpath, source_hash, lineno, loop_id)
+        loop_code = cache_get(_LOOP_CODE_CONTENT_CACHE, content_key)
+        if loop_code is not None:
+            break
         try:
-            itervars, found_loop_id = isolate_loop_body_and_get_itervars(tree, lineno=loop_frame_info[2], loop_id=loop_id)
-            return compile(tree, filename="", mode="exec"), format_itervars(itervars), found_loop_id
+            body, itervars, found_loop_id, at_module_level = isolate_loop_body_and_get_itervars(tree, source, lineno=lineno, loop_id=loop_id)
+            itervar_names = get_itervar_names(itervars)
+            # bodies of loops inside functions still need to be exec'd, as a function
+            # can't write to the fast locals of the function containing the loop
+            func = make_body_function(body, itervar_names) if at_module_level else None
+            if func is not None:
+                body = [func]
+            module = ast.fix_missing_locations(ast.Module(body=body, type_ignores=[]))
+            loop_code = (
+                compile(module, filename=fpath, mode="exec"),
+                get_unpack_code(itervars, itervar_names),
+                itervar_names,
+                found_loop_id,
+                at_module_level,
+                func is not None,
+            )
+            cache_put(_LOOP_CODE_CONTENT_CACHE, content_key, loop_code)
+            break
         except LookupError:
             handle_exception(fpath)
 
+    if key is not None:
+        cache_put(_LOOP_CODE_CACHE, key, loop_code)
+    return loop_code
+
 
 def handle_exception(fpath):
-    exc = traceback.format_exc()
-    exc = exc.replace('File "<string>"', 'File "{}"'.format(fpath))
-    sys.stderr.write(exc + "\n")
+    # reloaded code is compiled with fpath as file name, so the traceback can be
+    # written line by line without patching file names in the formatted string
+    exc = traceback.TracebackException(*sys.exc_info(), lookup_lines=False)
+    sys.stderr.writelines(exc.format())
+    sys.stderr.write("\n")
     print("Edit {} and press return to continue".format(fpath))
     sys.stdin.readline()
 
 
 def _reloading_loop(seq, every=1):
-    loop_frame_info = inspect.stack()[2]
-    fpath = loop_frame_info[1]
+    # sys._getframe avoids loading the source of every frame like inspect.stack
+    frame = sys._getframe(2)
+    fpath = frame.f_code.co_filename
+    lineno = frame.f_lineno
 
-    caller_globals = loop_frame_info[0].f_globals
-    caller_locals = loop_frame_info[0].f_locals
+    caller_globals = frame.f_globals
+    caller_locals = frame.f_locals
+    check_source_file(fpath)
 
-    # create a unique name in the caller namespace that we can safely write
-    # the values of the iteration variables into
-    unique = unique_name(chain(caller_locals.keys(), caller_globals.keys()))
     loop_id = None
+    last_stamp = None
+    body_fn = None
+
+    # bind the builtins and globals used in every iteration to fast locals
+    _exec = exec
+    _get_file_stamp = get_file_stamp
+    _handle_exception = handle_exception
 
     for i, itervar_values in enumerate(seq):
+        # only reload if the source file changed since the last reload
         if i % every == 0:
-            compiled_body, itervars, loop_id = get_loop_code(loop_frame_info, loop_id=loop_id)
-
-        caller_locals[unique] = itervar_values
-        exec(itervars + " = " + unique, caller_globals, caller_locals)
+            stamp = _get_file_stamp(fpath)
+            if stamp is None or stamp != last_stamp:
+                compiled_body, compiled_unpack, itervar_names, loop_id, at_module_level, body_is_function = \
+                    get_loop_code(fpath, lineno, loop_id=loop_id)
+                last_stamp = stamp
+                # module level loops nested in another reloading loop are called from
+                # its body function, but their state still belongs to the module
+                namespace = caller_globals if at_module_level else caller_locals
+                # only define the functions when reloading, not every iteration
+                scratch = {}
+                if compiled_unpack is None:
+                    unpack = None
+                else:
+                    _exec(compiled_unpack, caller_globals, scratch)
+                    unpack = scratch[UNPACK_FUNCTION_NAME]
+                if not body_is_function:
+                    body_fn = None
+                else:
+                    _exec(compiled_body, caller_globals, scratch)
+                    if body_fn is None:
+                        body_fn = scratch[BODY_FUNCTION_NAME]
+                    else:
+                        # patch the new code into the existing function instead of replacing it
+                        body_fn.__code__ = scratch[BODY_FUNCTION_NAME].__code__
+                        body_fn.__defaults__ = scratch[BODY_FUNCTION_NAME].__defaults__
+
+        # a single loop var can be assigned directly, otherwise the values
+        # are unpacked by a function compiled once per reload
+        if unpack is None:
+            values = (itervar_values,)
+        else:
+            values = unpack(itervar_values)
+        for name, value in zip(itervar_names, values):
+            namespace[name] = value
         try:
             # run main loop body
-            exec(compiled_body, caller_globals, caller_locals)
+            if body_fn is None:
+                _exec(compiled_body, caller_globals, namespace)
+            else:
+                body_fn()
         except Exception:
-            handle_exception(fpath)
+            _handle_exception(fpath)
 
     return []
 
 
 def get_decorator_name_or_none(dec_node):
-    if hasattr(dec_node, "id"):
+    # isinstance checks are cheaper than hasattr, which raises and catches
+    # an AttributeError for every miss
+    if isinstance(dec_node, ast.Call):
+        dec_node = dec_node.func
+    if isinstance(dec_node, ast.Name):
         return dec_node.id
-    elif hasattr(dec_node.func, "id"):
-        return dec_node.func.id
-    elif hasattr(dec_node.func.value, "id"):
-        return dec_node.func.value.id
+    elif isinstance(dec_node, ast.Attribute) and isinstance(dec_node.value, ast.Name):
+        return dec_node.value.id
     else:
         return None
 
 
 def strip_reloading_decorator(func):
-    """Remove the 'reloading' decorator and all decorators before it"""
-    decorator_names = [get_decorator_name(dec) for dec in func.decorator_list]
+    """Returns a copy of func without the 'reloading' decorator and all decorators before it"""
+    decorator_names = [get_decorator_name_or_none(dec) for dec in func.decorator_list]
     reloading_idx = decorator_names.index("reloading")
+    func = copy.copy(func)
     func.decorator_list = func.decorator_list[reloading_idx + 1:]
+    return func
+
 
+class ReloadingFunctionFinder(StatementVisitor):
+    """Finds the first definition of the function `funcname` decorated with `reloading`"""
 
-def isolate_function_def(funcname, tree):
-    """Strip everything but the function definition from the ast in-place.
-    Also strips the reloading decorator from the function definition"""
-    for node in ast.walk(tree):
+    def __init__(self, source, funcname):
+        super(ReloadingFunctionFinder, self).__init__(source)
+        self.funcname = funcname
+        self.func_node = None
+
+    def generic_visit(self, node):
+        if self.func_node is None:
+            super(ReloadingFunctionFinder, self).generic_visit(node)
+
+    def visit_FunctionDef(self, node):
         if (
-            isinstance(node, ast.FunctionDef)
-            and node.name == funcname
-            and "reloading" in [
-                get_decorator_name_or_none(dec)
-                for dec in node.decorator_list
-            ]
+            node.name == self.funcname
+            and any(get_decorator_name_or_none(dec) == "reloading" for dec in node.decorator_list)
         ):
-            strip_reloading_decorator(node)
-            tree.body = [ node ]
-            return True
-    return False
+            self.func_node = node
+        else:
+            super(ReloadingFunctionFinder, self).visit_FunctionDef(node)
 
 
-def get_function_def_code(fpath, fn):
-    tree = parse_file_until_successful(fpath)
-    found = isolate_function_def(fn.__name__, tree)
-    if not found:
+def isolate_function_def(funcname, tree, source):
+    """Returns the function definition without the reloading decorator or
+    None if it can't be found. Doesn't modify the tree"""
+    finder = ReloadingFunctionFinder(source, funcname)
+    finder.visit(tree)
+    if finder.func_node is None:
         return None
-    compiled = compile(tree, filename="", mode="exec")
+    return strip_reloading_decorator(finder.func_node)
+
+
+def get_function_def_code(fpath, fn):
+    stamp = get_file_stamp(fpath)
+    key = None if stamp is None else (fpath, stamp, fn.__name__)
+    if key is not None:
+        cached = cache_get(_FUNC_CODE_CACHE, key)
+        if cached is not None:
+            return cached
+
+    tree, source, source_hash = parse_file_until_successful(fpath)
+    # the file may have been saved without changing it
+    content_key = (fpath, source_hash, fn.__name__)
+    compiled = cache_get(_FUNC_CODE_CONTENT_CACHE, content_key)
+    if compiled is None:
+        func_node = isolate_function_def(fn.__name__, tree, source)
+        if func_node is None:
+            return None
+        module = ast.Module(body=[func_node], type_ignores=[])
+        compiled = compile(module, filename=fpath, mode="exec")
+        cache_put(_FUNC_CODE_CONTENT_CACHE, content_key, compiled)
+    if key is not None:
+        cache_put(_FUNC_CODE_CACHE, key, compiled)
     return compiled
 
 
-def get_reloaded_function(caller_globals, caller_locals, fpath, fn):
+def get_reloaded_function(caller_globals, caller_locals, fpath, fn, state):
     code = get_function_def_code(fpath, fn)
     if code is None:
         return None
-    # need to copy locals, otherwise the exec will overwrite the decorated with the undecorated new version
-    # this became a need after removing the reloading decorator from the newly defined version
-    caller_locals_copy = caller_locals.copy()
-    exec(code, caller_globals, caller_locals_copy)
-    func = caller_locals_copy[fn.__name__]
+    # the same code object means the definition is unchanged, so reuse the function defined from it
+    if code is state["code"]:
+        return state["func"]
+    # exec into an overlay, otherwise the exec will overwrite the decorated with the undecorated new version.
+    # lookups, e.g. of default arguments, still fall through to the caller locals without copying them
+    exec_ns = {}
+    exec(code, caller_globals, ChainMap(exec_ns, caller_locals))
+    func = exec_ns[fn.__name__]
+    state["code"] = code
     return func
 
 
 def _reloading_function(fn, every=1):
-    stack = inspect.stack()
-    frame, fpath = stack[2][:2]
+    frame = sys._getframe(2)
+    fpath = frame.f_code.co_filename
     caller_locals = frame.f_locals
     caller_globals = frame.f_globals
+    check_source_file(fpath)
 
     # crutch to use dict as python2 doesn't support nonlocal
     state = {
         "func": None,
+        "code": None,
         "reloads": 0,
+        "stamp": None,
     }
 
     def wrapped(*args, **kwargs):
         if state["reloads"] % every == 0:
-            state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn) or state["func"]
+            stamp = get_file_stamp(fpath)
+            if stamp is None or stamp != state["stamp"]:
+                state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn, state) or state["func"]
+                state["stamp"] = stamp
         state["reloads"] += 1
         while True:
             try:
@@ -257,7 +645,7 @@ def _reloading_function(fn, every=1):
                 return result
             except Exception:
                 handle_exception(fpath)
-                state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn) or state["func"]
+                state["func"] = get_reloaded_function(caller_globals, caller_locals, fpath, fn, state) or state["func"]
 
     caller_locals[fn.__name__] = wrapped
     return wrapped
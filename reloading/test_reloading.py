@@ -1,12 +1,22 @@
 import unittest
+import importlib
 import os
+import shutil
 import subprocess as sp
+import tempfile
+import threading
 import time
+import types
 
 from reloading import reloading
 
+# the package exports the reloading function under the module's name
+reloading_module = importlib.import_module("reloading.reloading")
+
 SRC_FILE_NAME = "temporary_testing_file.py"
 
+DECORATORS = types.SimpleNamespace(identity=lambda fn: fn)
+
 TEST_CHANGING_SOURCE_LOOP_CONTENT = """
 from reloading import reloading
 from time import sleep
@@ -60,6 +70,106 @@ for epoch in reloading(range(1)):
 assert state == 'CHANGED'
 """
 
+TEST_CHANGING_SOURCE_LOOP_IN_FUNCTION = """
+from reloading import reloading
+from time import sleep
+
+def unrelated():
+    pass
+
+def main():
+    for epoch in reloading(range(10)):
+        sleep(0.2)
+        print('INITIAL_FILE_CONTENTS')
+
+main()
+"""
+
+TEST_UNPACK_ITERVARS = """
+from reloading import reloading
+
+pairs = []
+for i, (a, b) in reloading(enumerate(zip('ab', 'cd'))):
+    pairs.append((i, a, b))
+
+print(pairs)
+"""
+
+TEST_NESTED_LOOP_STATE = """
+from reloading import reloading
+
+total = 0
+for i in reloading(range(3)):
+    def double(x):
+        return 2 * x
+    for j in reloading(range(2)):
+        total += double(i) + j
+
+print('STATE', total, i, j)
+"""
+
+TEST_CLOSURE_OVER_LOOP_VAR = """
+from reloading import reloading
+
+fns = []
+for i in reloading(range(3)):
+    fns.append(lambda: i)
+
+print('CLOSURES', [fn() for fn in fns])
+"""
+
+TEST_ANNOTATED_ASSIGNMENT_IN_LOOP = """
+from reloading import reloading
+
+for i in reloading(range(2)):
+    x: int = i
+
+print('ANN', x)
+"""
+
+TEST_EXEC_IN_LOOP = """
+from reloading import reloading
+
+for i in reloading(range(2)):
+    exec("made = i * 10")
+    has_i = "i" in vars()
+
+print('EXEC', made, has_i)
+"""
+
+TEST_UNCHANGED_SAVE_OF_FUNCTION = """
+import os
+from reloading import reloading
+
+calls = []
+
+def count(fn):
+    calls.append(fn)
+    return fn
+
+@reloading
+@count
+def f():
+    return 'INITIAL'
+
+f()
+f()
+print('DEFS', len(calls))
+
+# a save without changes only touches the modification time
+stat = os.stat(__file__)
+os.utime(__file__, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+f()
+print('TOUCHED', len(calls))
+
+with open(__file__) as src_file:
+    src = src_file.read()
+with open(__file__, 'w') as src_file:
+    src_file.write(src.replace('INIT' + 'IAL', 'CHANGED'))
+result = f()
+print('CHANGED', len(calls), result)
+"""
+
 TEST_COMMENT_AFTER_LOOP_CONTENT = """
 from reloading import reloading
 from time import sleep
@@ -126,6 +236,16 @@ def run_and_update_source(init_src, updated_src=None, update_after=0.5, bin="pyt
 
 
 class TestReloading(unittest.TestCase):
+    def test_missing_source_file(self):
+        # code passed via -c has no source file to reload from and must not wait for one
+        for bin in ["python", "python3"]:
+            proc = sp.run(
+                [bin, "-c", "from reloading import reloading\nfor i in reloading(range(2)): print(i)"],
+                stdout=sp.PIPE, stderr=sp.PIPE, timeout=5,
+            )
+            self.assertNotEqual(proc.returncode, 0)
+            self.assertTrue(b"FileNotFoundError" in proc.stderr)
+
     def test_simple_looping(self):
         iters = 0
         for _ in reloading(range(10)):
@@ -156,6 +276,16 @@ class TestReloading(unittest.TestCase):
 
             self.assertTrue("INITIAL_FILE_CONTENTS" in stdout and "CHANGED_FILE_CONTENTS" in stdout)
 
+    def test_changing_source_loop_in_function(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(
+                init_src=TEST_CHANGING_SOURCE_LOOP_IN_FUNCTION,
+                updated_src=TEST_CHANGING_SOURCE_LOOP_IN_FUNCTION.replace("INITIAL", "CHANGED").rstrip("\n"),
+                bin=bin,
+            )
+
+            self.assertTrue("INITIAL_FILE_CONTENTS" in stdout and "CHANGED_FILE_CONTENTS" in stdout)
+
     def test_comment_after_loop(self):
         for bin in ["python", "python3"]:
             stdout, _ = run_and_update_source(
@@ -185,6 +315,31 @@ class TestReloading(unittest.TestCase):
             _, has_error = run_and_update_source(init_src=TEST_PERSIST_AFTER_LOOP, bin=bin)
             self.assertFalse(has_error)
 
+    def test_unpack_itervars(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_UNPACK_ITERVARS, bin=bin)
+            self.assertTrue("[(0, 'a', 'c'), (1, 'b', 'd')]" in stdout)
+
+    def test_nested_loop_state(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_NESTED_LOOP_STATE, bin=bin)
+            self.assertTrue("STATE 15 2 1" in stdout)
+
+    def test_closure_over_loop_var(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_CLOSURE_OVER_LOOP_VAR, bin=bin)
+            self.assertTrue("CLOSURES [2, 2, 2]" in stdout)
+
+    def test_annotated_assignment_in_loop(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_ANNOTATED_ASSIGNMENT_IN_LOOP, bin=bin)
+            self.assertTrue("ANN 1" in stdout)
+
+    def test_exec_in_loop(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_EXEC_IN_LOOP, bin=bin)
+            self.assertTrue("EXEC 10 True" in stdout)
+
     def test_simple_function(self):
         @reloading
         def some_func():
@@ -192,6 +347,22 @@ class TestReloading(unittest.TestCase):
 
         self.assertTrue(some_func() == "result")
 
+    def test_attribute_decorated_function(self):
+        @DECORATORS.identity
+        @reloading
+        @DECORATORS.identity
+        def attribute_decorated_func():
+            return "result"
+
+        self.assertTrue(attribute_decorated_func() == "result")
+
+    def test_unchanged_save_of_function(self):
+        for bin in ["python", "python3"]:
+            stdout, _ = run_and_update_source(init_src=TEST_UNCHANGED_SAVE_OF_FUNCTION, bin=bin)
+            self.assertTrue("DEFS 2" in stdout)
+            self.assertTrue("TOUCHED 2" in stdout)
+            self.assertTrue("CHANGED 3 CHANGED" in stdout)
+
     def test_reloading_function(self):
         for bin in ["python", "python3"]:
             stdout, _ = run_and_update_source(
@@ -212,5 +383,59 @@ class TestReloading(unittest.TestCase):
             self.assertTrue("INITIAL_FILE_CONTENTS" in stdout and "CHANGED_FILE_CONTENTS" in stdout)
 
 
+def write_later(fn, delay=0.2):
+    """Calls fn in a thread after delay seconds, like an editor saving a file"""
+    thread = threading.Timer(delay, fn)
+    thread.start()
+    return thread
+
+
+class TestLoadFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "source.py")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, src):
+        with open(path, "w") as f:
+            f.write(src)
+
+    def test_empty_then_written(self):
+        self.write(self.path, "")
+        writer = write_later(lambda: self.write(self.path, "x = 1"))
+        self.assertEqual(reloading_module.load_file(self.path), b"x = 1")
+        writer.join()
+
+    def test_missing_then_renamed(self):
+        tmp_path = self.path + ".tmp"
+        self.write(tmp_path, "x = 1")
+        writer = write_later(lambda: os.rename(tmp_path, self.path))
+        self.assertEqual(reloading_module.load_file(self.path), b"x = 1")
+        writer.join()
+
+    @unittest.skipIf(reloading_module.INotify is None, "inotify_simple is not installed")
+    def test_wait_for_write_inotify(self):
+        self.write(self.path, "")
+        writer = write_later(lambda: self.write(self.path, "x = 1"))
+        # waiting on the watcher doesn't back off
+        self.assertEqual(reloading_module.wait_for_write(self.path, 0.001), 0.001)
+        writer.join()
+        self.assertEqual(reloading_module.load_file(self.path), b"x = 1")
+
+    def test_wait_for_write_polling(self):
+        inotify = reloading_module.INotify
+        reloading_module.INotify = None
+        try:
+            self.assertEqual(reloading_module.wait_for_write(self.path, 0.001), 0.002)
+            self.write(self.path, "")
+            writer = write_later(lambda: self.write(self.path, "x = 1"))
+            self.assertEqual(reloading_module.load_file(self.path), b"x = 1")
+            writer.join()
+        finally:
+            reloading_module.INotify = inotify
+
+
 if __name__ == "__main__":
     unittest.main()
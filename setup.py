@@ -19,14 +19,14 @@ setup(
   download_url='https://github.com/julvo/reloading/archive/v1.1.2.tar.gz',
   keywords=['reload', 'reloading', 'refresh', 'loop', 'decorator'],
   install_requires=[],
+  extras_require={'inotify': ['inotify_simple']},
+  python_requires='>=3.6',
   classifiers=[
     'Development Status :: 3 - Alpha',
     'Intended Audience :: Developers',
     'Topic :: Utilities',
     'License :: OSI Approved :: MIT License',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.4',
-    'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',
     'Programming Language :: Python :: 3.7',
     'Programming Language :: Python :: 3.8',